@@ -2,14 +2,30 @@
 
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
 import json
-import re
+import sys
+import threading
 import time
+import traceback
+
+# orjson decodes core's metrics payload considerably faster, fall back to stdlib json without it
+try:
+  import orjson
+  json_loads = orjson.loads
+except ImportError:
+  json_loads = json.loads
 
 # Prometheus client library
 from prometheus_client import start_http_server
 from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, SummaryMetricFamily, REGISTRY
 
+def positive_float(value):
+  number = float(value)
+  if number <= 0:
+    raise argparse.ArgumentTypeError('%s is not a positive number' % value)
+  return number
+
 parser = argparse.ArgumentParser(description='simple stellar-core Prometheus exporter/scraper')
 parser.add_argument('--uri', type=str,
                     help='core metrics uri, default: http://127.0.0.1:11626/metrics',
@@ -17,35 +33,130 @@ parser.add_argument('--uri', type=str,
 parser.add_argument('--port', type=int,
                     help='HTTP bind port, default: 9473',
                     default=9473)
+parser.add_argument('--timeout', type=positive_float,
+                    help='core metrics request timeout in seconds, default: 5',
+                    default=5.0)
+parser.add_argument('--refresh-interval', type=positive_float,
+                    help='seconds between scrapes of core, default: 10',
+                    default=10.0)
 args = parser.parse_args()
 
+# keep-alive session shared by all scrapes, requests against core reuse one connection
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+# characters libmedida uses in metric names that are not valid in Prometheus names,
+# an ordinal table works with both str.translate and Python 2 unicode.translate
+SANITIZE_TABLE = dict((ord(c), u'_') for c in u'.- \t\n\r\x0b\x0c')
+
+# quantile labels shared by every timer summary, samples only read them
+QUANTILE_75 = {'quantile': '0.75'}
+QUANTILE_99 = {'quantile': '0.99'}
+
+def timer_family(underscores, m):
+  # we have a timer, expose as a Prometheus Summary
+  underscores = underscores + '_' + m['duration_unit']
+  count = m['count']
+  summary = SummaryMetricFamily(underscores, 'libmedida metric type: timer', count_value=count, sum_value=(m['mean'] * count))
+  # add stellar-core calculated quantiles to our summary
+  summary.add_sample(underscores, labels=QUANTILE_75, value=m['75%'])
+  summary.add_sample(underscores, labels=QUANTILE_99, value=m['99%'])
+  return summary
+
+def counter_family(underscores, m):
+  # we have a counter, this is a Prometheus Gauge
+  return GaugeMetricFamily(underscores, 'libmedida metric type: counter', value=m['count'])
+
+def meter_family(underscores, m):
+  # we have a meter, this is a Prometheus Counter
+  return CounterMetricFamily(underscores, 'libmedida metric type: meter', value=m['count'])
+
+# libmedida metric type -> builder of the matching Prometheus metric family, other types are skipped
+FAMILY_BUILDERS = {
+  'timer':   timer_family,
+  'counter': counter_family,
+  'meter':   meter_family,
+}
+
 class StellarCoreCollector(object):
-  def collect(self):
-    response = requests.get(args.uri)
-    json = response.json()
+  def __init__(self):
+    # sanitized Prometheus names keyed by libmedida metric name, stable for the life of core
+    self.names = {}
+    # metric families from the most recent scrape, served to every Prometheus poll
+    self.families = []
+    self.success = 0
+    self.last_success = 0
+    self.lock = threading.RLock()
+
+  def refresh(self):
+    try:
+      families = self.scrape()
+    except Exception:
+      # don't keep serving stale values, a dead core must not look healthy
+      with self.lock:
+        self.families = []
+        self.success = 0
+      raise
+
+    with self.lock:
+      self.families = families
+      self.success = 1
+      self.last_success = time.time()
+
+  def scrape(self):
+    response = SESSION.get(args.uri, timeout=args.timeout)
+    response.raise_for_status()
+    data = json_loads(response.content)
     
-    metrics   = json['metrics']
+    metrics   = data['metrics']
+    families  = []
 
     # iterate over all metrics
-    for k in metrics:
-      underscores = re.sub('\.|-|\s', '_', k).lower()
-      
-      if metrics[k]['type'] == 'timer':
-        # we have a timer, expose as a Prometheus Summary
-        underscores = underscores + '_' + metrics[k]['duration_unit']
-        summary = SummaryMetricFamily(underscores, 'libmedida metric type: ' + metrics[k]['type'], count_value=metrics[k]['count'], sum_value=(metrics[k]['mean'] * metrics[k]['count']))
-        # add stellar-core calculated quantiles to our summary
-        summary.add_sample(underscores, labels={'quantile':'0.75'}, value=metrics[k]['75%']) 
-        summary.add_sample(underscores, labels={'quantile':'0.99'}, value=metrics[k]['99%']) 
-        yield summary
-      elif metrics[k]['type'] == 'counter':
-        # we have a counter, this is a Prometheus Gauge
-        yield GaugeMetricFamily(underscores, 'libmedida metric type: ' + metrics[k]['type'], value=metrics[k]['count'])
-      elif metrics[k]['type'] == 'meter':
-        # we have a meter, this is a Prometheus Counter
-        yield CounterMetricFamily(underscores, 'libmedida metric type: ' + metrics[k]['type'], value=metrics[k]['count'])
+    for k, m in metrics.items():
+      build = FAMILY_BUILDERS.get(m['type'])
+      if build is None:
+        continue
+      underscores = self.names.get(k)
+      if underscores is None:
+        underscores = self.names[k] = k.translate(SANITIZE_TABLE).lower()
+      families.append(build(underscores, m))
+
+    return families
+
+  def describe(self):
+    # core's metric names are only known after a scrape, keep register() from calling collect()
+    return []
+
+  def collect(self):
+    with self.lock:
+      if not self.success:
+        # fail the exposition so Prometheus marks the target down, as when it scraped core directly
+        raise RuntimeError('last scrape of %s failed' % args.uri)
+      families = list(self.families)
+      last_success = self.last_success
+
+    families.append(GaugeMetricFamily('stellar_core_exporter_last_success_timestamp_seconds', 'unix time of the last successful scrape of stellar-core', value=last_success))
+    return families
+
+def refresh_once(collector):
+  # stdout is block buffered under systemd, report failures on stderr
+  try:
+    collector.refresh()
+  except (requests.RequestException, ValueError) as e:
+    sys.stderr.write('failed to scrape %s: %s: %s\n' % (args.uri, type(e).__name__, e))
+  except Exception:
+    # unexpected payload or a bug, keep the traceback
+    sys.stderr.write('failed to process metrics from %s\n' % args.uri)
+    traceback.print_exc()
 
 if __name__ == "__main__":
-  REGISTRY.register(StellarCoreCollector())
+  collector = StellarCoreCollector()
+  # populate the first snapshot before serving so early polls aren't empty
+  refresh_once(collector)
+  REGISTRY.register(collector)
   start_http_server(args.port)
-  while True: time.sleep(1)
+  # refresh from the main thread, if this loop ever dies the process exits and systemd restarts it
+  while True:
+    time.sleep(args.refresh_interval)
+    refresh_once(collector)